@@ -1,15 +1,44 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import configparser
 import datetime
+import errno
+import fcntl
+import functools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import signal
+import stat
 import subprocess
 import sys
-from dataclasses import dataclass
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence
+from typing import (
+    IO,
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 
 DEFAULT_CONFIG_FILE = "/etc/zabwrap/zabwrap.conf"
@@ -25,11 +54,99 @@ DEFAULT_BACKUP_TYPES = {
     "scratch": "",
 }
 
+# Filesystem or volume name; snapshots and bookmarks are not accepted.
+DATASET_NAME_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9_.: -]*(?:/[A-Za-z0-9_.: -]+)*")
+
+# zfs get error for one dataset; the other datasets in the call are still read.
+ZFS_CANNOT_OPEN_PATTERN = re.compile(r"^cannot open '([^']+)'.*$", re.MULTILINE)
+
+# Datasets per zfs get call; keeps the argument list well below ARG_MAX.
+ZFS_GET_BATCH_SIZE = 256
+
+# Datasets per zfs set or zfs program call that writes zab:lastbackup.
+ZFS_SET_BATCH_SIZE = 256
+
+# Dataset and status argument bytes per zfs program call. Statuses can carry
+# a long stderr tail, so batches are also capped by size to stay clear of
+# E2BIG.
+ZFS_PROGRAM_ARGUMENT_BYTES = 64 * 1024
+
+# Every source a user property can have. Leaving out temporary, default
+# and none also keeps unset native properties out of zfs get all output.
+USER_PROPERTY_SOURCES = "local,inherited,received"
+
 RED = "\033[31m"
 YELLOW = "\033[33m"
 GREEN = "\033[32m"
 RESET = "\033[0m"
 
+# Options shared by every zfs-autobackup run, as flag to value; None marks
+# a flag that takes no value. Keying by flag rules out duplicate options.
+COMMON_BACKUP_OPTIONS: Dict[str, Optional[str]] = {
+    "--verbose": None,
+    "--exclude-received": None,
+    # Always enabled by design. This preserves and transfers snapshots
+    # not created by zfs-autobackup.
+    "--other-snapshots": None,
+}
+
+# Fixed options for routine backups; only the selection, target path,
+# server and retention vary per call.
+# --destroy-incompatible is intentionally not used during routine backups.
+REMOTE_BACKUP_OPTIONS: Dict[str, Optional[str]] = {
+    "--strip-path": "1",
+    "--clear-mountpoint": None,
+    **COMMON_BACKUP_OPTIONS,
+}
+
+# No target-only options are included here. With no target path,
+# zfs-autobackup creates a local snapshot and thins source snapshots.
+SANDBOX_BACKUP_OPTIONS = COMMON_BACKUP_OPTIONS
+
+# Bumped whenever the layout of the property cache file changes.
+PROPERTY_CACHE_VERSION = 1
+
+# Rewritten on pool import, export and configuration changes.
+ZPOOL_CACHE_FILE = Path("/etc/zfs/zpool.cache")
+
+# Sets zab:lastbackup from alternating dataset and value arguments in one
+# transaction group, returning the datasets that could not be updated.
+LASTBACKUP_CHANNEL_PROGRAM = """\
+local argv = (...)["argv"]
+local failed = {}
+for i = 1, #argv, 2 do
+    local err = zfs.sync.set_prop(argv[i], "zab:lastbackup", argv[i + 1])
+    if err ~= 0 then
+        failed[argv[i]] = err
+    end
+end
+return failed
+"""
+
+# Lines of zfs-autobackup stderr kept for the zab:lastbackup failure message.
+STDERR_TAIL_LINES = 20
+
+# How long to wait for output relays once zfs-autobackup has exited. A
+# leftover descendant can keep the pipes open indefinitely.
+RELAY_JOIN_TIMEOUT_SECONDS = 5
+
+# flock errors meaning the lockfile's filesystem has no flock support.
+FLOCK_UNSUPPORTED_ERRNOS = (errno.ENOLCK, errno.EOPNOTSUPP)
+
+# Serializes terminal output from concurrently running backups.
+OUTPUT_LOCK = threading.Lock()
+
+# zfs-autobackup processes still running. They sit in their own sessions, so
+# an interrupted run has to kill them itself.
+RUNNING_PROCESSES: Set[subprocess.Popen] = set()
+RUNNING_PROCESSES_LOCK = threading.Lock()
+
+# zfs-autobackup selection names: "/" becomes "-" and ASCII letters are lowercased.
+SELECTION_NAME_TABLE = str.maketrans(
+    "/ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+    "-abcdefghijklmnopqrstuvwxyz",
+)
+
 
 @dataclass
 class Settings:
@@ -38,15 +155,51 @@ class Settings:
     loaded_config_files: List[Path]
     lockfile_path: Path
     logfile_path: Path
+    cache_file: Path
+    zfs: str
     zfs_autobackup: str
+    ssh: str
     zabbix_sender: str
     zabbix_server: str
     psk_identity: str
     psk_file: str
+    zabbix_host: str
+    zabbix_key: str
     command_timeout_seconds: Optional[int]
+    concurrency: int
+    cache_ttl_seconds: int
+    ssh_multiplex: bool
+    ssh_control_persist_seconds: int
     backup_types: Dict[str, str]
 
 
+@dataclass
+class ProcessLock:
+    path: Path
+    descriptor: int
+    # A PID file created with O_EXCL holds the lock until it is removed.
+    remove_on_release: bool = False
+
+
+@dataclass
+class BackupTask:
+    fs: str
+    zabselect: str
+    retention: str
+    destinations: List[Tuple[str, str]] = field(default_factory=list)
+    sandbox: bool = False
+
+
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"invalid integer: {value!r}") from exc
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
 def build_argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="ZFS autobackup wrapper")
     parser.add_argument(
@@ -83,6 +236,16 @@ def build_argument_parser() -> argparse.ArgumentParser:
         nargs="+",
         help="Limit the list of filesystems to process",
     )
+    parser.add_argument(
+        "--concurrency",
+        "--parallel",
+        "-p",
+        type=positive_int,
+        help=(
+            "Number of filesystems to back up at once "
+            "(default: runtime.concurrency from the configuration, or 1)"
+        ),
+    )
     parser.add_argument(
         "--debug",
         "-v",
@@ -134,6 +297,13 @@ def get_config_files(config_file: Path, config_dir: Path) -> List[Path]:
     return config_files
 
 
+def resolve_executable(command: str) -> str:
+    """Resolve a bare command name against PATH once instead of per spawn."""
+    if not command or os.sep in command:
+        return command
+    return shutil.which(command) or command
+
+
 def load_settings(config_file_name: str, config_dir_name: str) -> Settings:
     config_file = Path(config_file_name)
     config_dir = Path(config_dir_name)
@@ -182,6 +352,23 @@ def load_settings(config_file_name: str, config_dir_name: str) -> Settings:
     if timeout_seconds < 0:
         raise RuntimeError("runtime.command_timeout_seconds cannot be negative")
 
+    concurrency = parser.getint("runtime", "concurrency", fallback=1)
+    if concurrency < 1:
+        raise RuntimeError("runtime.concurrency must be at least 1")
+
+    cache_ttl_seconds = parser.getint("runtime", "cache_ttl_seconds", fallback=0)
+    if cache_ttl_seconds < 0:
+        raise RuntimeError("runtime.cache_ttl_seconds cannot be negative")
+
+    ssh_multiplex = parser.getboolean("ssh", "multiplex", fallback=False)
+    ssh_control_persist_seconds = parser.getint(
+        "ssh",
+        "control_persist_seconds",
+        fallback=60,
+    )
+    if ssh_control_persist_seconds < 1:
+        raise RuntimeError("ssh.control_persist_seconds must be at least 1")
+
     settings = Settings(
         config_file=config_file,
         config_dir=config_dir,
@@ -200,11 +387,20 @@ def load_settings(config_file_name: str, config_dir_name: str) -> Settings:
                 fallback="/var/log/zfs_backup.log",
             )
         ),
+        cache_file=Path(
+            parser.get(
+                "paths",
+                "cache_file",
+                fallback="/var/cache/zabwrap/state.json",
+            )
+        ),
+        zfs=resolve_executable(parser.get("paths", "zfs", fallback="zfs").strip()),
         zfs_autobackup=parser.get(
             "paths",
             "zfs_autobackup",
             fallback="/usr/local/bin/zfs-autobackup",
         ).strip(),
+        ssh=resolve_executable(parser.get("paths", "ssh", fallback="ssh").strip()),
         zabbix_sender=parser.get(
             "zabbix",
             "sender",
@@ -225,29 +421,59 @@ def load_settings(config_file_name: str, config_dir_name: str) -> Settings:
             "psk_file",
             fallback="/etc/zabbix/zabbix_agent.psk",
         ).strip(),
+        zabbix_host=parser.get("zabbix", "host", fallback="").strip(),
+        zabbix_key=parser.get(
+            "zabbix",
+            "key",
+            fallback="zab.lastbackup",
+        ).strip(),
         command_timeout_seconds=timeout_seconds or None,
+        concurrency=concurrency,
+        cache_ttl_seconds=cache_ttl_seconds,
+        ssh_multiplex=ssh_multiplex,
+        ssh_control_persist_seconds=ssh_control_persist_seconds,
         backup_types=backup_types,
     )
 
+    if not settings.zfs:
+        raise RuntimeError("paths.zfs cannot be empty")
     if not settings.zfs_autobackup:
         raise RuntimeError("paths.zfs_autobackup cannot be empty")
+    if not settings.ssh:
+        raise RuntimeError("paths.ssh cannot be empty")
     if not settings.zabbix_sender:
         raise RuntimeError("zabbix.sender cannot be empty")
+    if settings.zabbix_host and not settings.zabbix_key:
+        raise RuntimeError("zabbix.key cannot be empty when zabbix.host is set")
 
     return settings
 
 
 def configure_logging(logfile_path: Path) -> None:
+    """Queue log records for a listener thread that writes them to the file."""
     try:
-        logging.basicConfig(
-            filename=str(logfile_path),
-            level=logging.INFO,
-            format="%(asctime)s %(levelname)s %(message)s",
-            force=True,
-        )
+        file_handler = logging.FileHandler(str(logfile_path))
     except OSError as exc:
         raise RuntimeError(f"Unable to configure logging to {logfile_path}: {exc}") from exc
 
+    file_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    )
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    # Registered after logging's own shutdown hook, so it runs first and
+    # drains the queue before the handlers are flushed and closed.
+    atexit.register(listener.stop)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[queue_handler],
+        force=True,
+    )
+
 
 def print_effective_config(settings: Settings) -> None:
     print("Configuration files loaded:")
@@ -260,7 +486,10 @@ def print_effective_config(settings: Settings) -> None:
     print("Effective paths:")
     print(f"  lockfile = {settings.lockfile_path}")
     print(f"  logfile = {settings.logfile_path}")
+    print(f"  cache_file = {settings.cache_file}")
+    print(f"  zfs = {settings.zfs}")
     print(f"  zfs_autobackup = {settings.zfs_autobackup}")
+    print(f"  ssh = {settings.ssh}")
     print(f"  config = {settings.config_file}")
     print(f"  config_dir = {settings.config_dir}")
 
@@ -269,9 +498,21 @@ def print_effective_config(settings: Settings) -> None:
     print(f"  server = {settings.zabbix_server}")
     print(f"  psk_identity = {settings.psk_identity}")
     print(f"  psk_file = {settings.psk_file}")
+    print(f"  host = {settings.zabbix_host or 'disabled'}")
+    print(f"  key = {settings.zabbix_key}")
 
     timeout = settings.command_timeout_seconds or "disabled"
     print(f"Command timeout: {timeout}")
+    print(f"Concurrency: {settings.concurrency}")
+    cache_ttl = settings.cache_ttl_seconds or "disabled"
+    print(f"Property cache TTL: {cache_ttl}")
+    if settings.ssh_multiplex:
+        print(
+            "SSH multiplexing: enabled "
+            f"(persist {settings.ssh_control_persist_seconds}s)"
+        )
+    else:
+        print("SSH multiplexing: disabled")
     print("Other snapshots: always enabled")
     print("Destroy incompatible: disabled")
 
@@ -284,12 +525,20 @@ def print_effective_config(settings: Settings) -> None:
 def run_subprocess(
     cmd: Sequence[str],
     timeout: Optional[int] = None,
+    input_text: Optional[str] = None,
+    capture_stdout: bool = True,
+    use_sudo: bool = False,
 ) -> Optional[subprocess.CompletedProcess]:
-    command = list(cmd)
+    # Already root: running sudo would only add another fork and exec.
+    if use_sudo and os.geteuid() != 0:
+        command = ["sudo", *cmd]
+    else:
+        command = list(cmd)
     try:
         return subprocess.run(
             command,
-            stdout=subprocess.PIPE,
+            input=input_text,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             text=True,
             timeout=timeout,
@@ -311,100 +560,264 @@ def run_subprocess(
         return subprocess.CompletedProcess(command, 127, "", str(exc))
 
 
-def process_is_running(pid: int) -> bool:
-    if pid <= 0:
-        return False
+def relay_output(
+    stream: IO[str],
+    target: IO[str],
+    prefix: str,
+    tail: Optional[Deque[str]] = None,
+) -> None:
+    with stream:
+        for line in stream:
+            with OUTPUT_LOCK:
+                print(f"{prefix}{line}", end="", file=target)
+                if not line.endswith("\n"):
+                    print(file=target)
+            if tail is not None:
+                tail.append(line)
+
+
+def join_relays(relays: Sequence[threading.Thread]) -> None:
+    deadline = time.monotonic() + RELAY_JOIN_TIMEOUT_SECONDS
+    for relay in relays:
+        relay.join(max(0.0, deadline - time.monotonic()))
+        if relay.is_alive():
+            logging.warning("Output relay still open; leaving it behind")
+
+
+def kill_process_group(process: subprocess.Popen) -> None:
     try:
-        os.kill(pid, 0)
+        os.killpg(process.pid, signal.SIGKILL)
     except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def kill_running_processes() -> None:
+    with RUNNING_PROCESSES_LOCK:
+        processes = list(RUNNING_PROCESSES)
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def run_streaming_subprocess(
+    cmd: Sequence[str],
+    prefix: Optional[str],
+    timeout: Optional[int] = None,
+) -> Optional[subprocess.CompletedProcess]:
+    """Relay a command's output line by line as it runs.
+
+    Only the last STDERR_TAIL_LINES lines of stderr are kept for the
+    returned CompletedProcess; stdout is not retained at all. Without a
+    prefix, stdout is inherited and goes straight to the terminal.
+    """
+    command = list(cmd)
+    if prefix is None:
+        # Keep our own buffered output ahead of the child's.
+        sys.stdout.flush()
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=None if prefix is None else subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            # Its own process group, so a timeout can kill zfs send and ssh too.
+            start_new_session=True,
+        )
+    except OSError as exc:
+        logging.error("Unable to execute command %s: %s", " ".join(command), exc)
+        print(
+            f"{RED}Unable to execute {' '.join(command)}: {exc}{RESET}",
+            file=sys.stderr,
+        )
+        return subprocess.CompletedProcess(command, 127, "", str(exc))
+    with RUNNING_PROCESSES_LOCK:
+        RUNNING_PROCESSES.add(process)
+
+    stderr_tail: Deque[str] = collections.deque(maxlen=STDERR_TAIL_LINES)
+    relays = [
+        threading.Thread(
+            target=relay_output,
+            args=(process.stderr, sys.stderr, prefix or "", stderr_tail),
+            daemon=True,
+        ),
+    ]
+    if process.stdout is not None:
+        relays.append(
+            threading.Thread(
+                target=relay_output,
+                args=(process.stdout, sys.stdout, prefix),
+                daemon=True,
+            )
+        )
+    for relay in relays:
+        relay.start()
+
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        join_relays(relays)
+        logging.error("Command timed out: %s", " ".join(command))
+        print(
+            f"{RED}Timeout expired while running: {' '.join(command)}{RESET}",
+            file=sys.stderr,
+        )
+        return None
+    except BaseException:
+        # The new session keeps Ctrl-C from reaching the child, so stop it here.
+        kill_process_group(process)
+        raise
+    finally:
+        with RUNNING_PROCESSES_LOCK:
+            RUNNING_PROCESSES.discard(process)
+
+    join_relays(relays)
+    return subprocess.CompletedProcess(command, returncode, "", "".join(stderr_tail))
+
+
+def report_running_instance(existing_pid: str) -> NoReturn:
+    existing_pid = existing_pid or "unknown"
+    logging.error(
+        "Another instance of the script is running with PID %s.",
+        existing_pid,
+    )
+    print(
+        f"{RED}Another instance of the script is running "
+        f"with PID {existing_pid}.{RESET}",
+        file=sys.stderr,
+    )
+    raise SystemExit(1)
+
+
+def lock_with_flock(lockfile_path: Path) -> Optional[int]:
+    """Flock the lockfile, or return None if its filesystem cannot flock."""
+    try:
+        descriptor = os.open(
+            str(lockfile_path),
+            os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+            0o600,
+        )
+    except OSError as exc:
+        raise RuntimeError(f"Unable to open lockfile {lockfile_path}: {exc}") from exc
+
+    if not stat.S_ISREG(os.fstat(descriptor).st_mode):
+        os.close(descriptor)
+        raise RuntimeError(f"Lockfile {lockfile_path} is not a regular file")
+
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        try:
+            contents = os.read(descriptor, 32).decode("utf-8", "replace").strip()
+        except OSError:
+            contents = ""
+        os.close(descriptor)
+        report_running_instance(contents)
+    except OSError as exc:
+        os.close(descriptor)
+        if exc.errno in FLOCK_UNSUPPORTED_ERRNOS:
+            logging.warning("flock is not supported for %s: %s", lockfile_path, exc)
+            return None
+        raise RuntimeError(f"Unable to lock {lockfile_path}: {exc}") from exc
+
+    return descriptor
+
+
+def pid_is_stale(existing_pid: str) -> bool:
+    if not existing_pid.isdigit():
         return False
-    except PermissionError:
+    try:
+        os.kill(int(existing_pid), 0)
+    except ProcessLookupError:
         return True
-    return True
-
+    except OSError:
+        return False
+    return False
 
-def acquire_lock(lockfile_path: Path) -> None:
-    """Create a PID lock, removing it only when it is demonstrably stale."""
-    lockfile_path.parent.mkdir(parents=True, exist_ok=True)
 
-    for _attempt in range(2):
+def lock_with_pid_file(pid_path: Path) -> int:
+    """Create the PID file exclusively, replacing it once if its owner is gone."""
+    for attempt in range(2):
         try:
-            descriptor = os.open(
-                str(lockfile_path),
-                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            return os.open(
+                str(pid_path),
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
                 0o600,
             )
         except FileExistsError:
-            existing_pid: Optional[int] = None
-            try:
-                contents = lockfile_path.read_text(encoding="utf-8").strip()
-                existing_pid = int(contents)
-            except (OSError, ValueError):
-                pass
-
-            if existing_pid is not None and process_is_running(existing_pid):
-                logging.error(
-                    "Another instance of the script is running with PID %s.",
-                    existing_pid,
-                )
-                print(
-                    f"{RED}Another instance of the script is running "
-                    f"with PID {existing_pid}.{RESET}",
-                    file=sys.stderr,
-                )
-                raise SystemExit(1)
-
             try:
-                lockfile_path.unlink()
-            except FileNotFoundError:
+                existing_pid = pid_path.read_text(encoding="utf-8").strip()
+            except OSError:
+                existing_pid = ""
+            if attempt == 0 and pid_is_stale(existing_pid):
+                logging.warning("Removing stale PID file %s", pid_path)
+                try:
+                    pid_path.unlink()
+                except FileNotFoundError:
+                    pass
                 continue
-            except OSError as exc:
-                raise RuntimeError(
-                    f"Unable to remove stale lockfile {lockfile_path}: {exc}"
-                ) from exc
-            continue
+            report_running_instance(existing_pid)
         except OSError as exc:
-            raise RuntimeError(
-                f"Unable to create lockfile {lockfile_path}: {exc}"
-            ) from exc
+            raise RuntimeError(f"Unable to create {pid_path}: {exc}") from exc
+    raise RuntimeError(f"Unable to create {pid_path}: it keeps reappearing")
 
-        with os.fdopen(descriptor, "w", encoding="utf-8") as lock_file:
-            lock_file.write(str(os.getpid()))
-            lock_file.flush()
-            os.fsync(lock_file.fileno())
 
-        logging.info("Lock acquired, no other instances are running.")
-        print(f"{GREEN}Lock acquired, no other instances are running.{RESET}")
-        return
+def acquire_lock(lockfile_path: Path) -> ProcessLock:
+    """Take an exclusive flock on the lockfile; the kernel drops it on exit.
 
-    raise RuntimeError(f"Unable to acquire lockfile {lockfile_path}")
+    Where the filesystem has no flock support (some NFS mounts), fall back
+    to an exclusively created PID file next to the lockfile.
+    """
+    lockfile_path.parent.mkdir(parents=True, exist_ok=True)
 
+    descriptor = lock_with_flock(lockfile_path)
+    if descriptor is None:
+        pid_path = lockfile_path.with_name(lockfile_path.name + ".pid")
+        lock = ProcessLock(
+            pid_path,
+            lock_with_pid_file(pid_path),
+            remove_on_release=True,
+        )
+    else:
+        lock = ProcessLock(lockfile_path, descriptor)
 
-def release_lock(lockfile_path: Path) -> None:
     try:
-        contents = lockfile_path.read_text(encoding="utf-8").strip()
-    except FileNotFoundError:
-        return
+        os.ftruncate(lock.descriptor, 0)
+        os.write(lock.descriptor, str(os.getpid()).encode("utf-8"))
+        os.fsync(lock.descriptor)
     except OSError as exc:
-        logging.error("Unable to read lockfile during release: %s", exc)
-        return
+        os.close(lock.descriptor)
+        raise RuntimeError(f"Unable to write lockfile {lock.path}: {exc}") from exc
 
-    if contents != str(os.getpid()):
-        logging.error(
-            "Refusing to remove lockfile %s because it belongs to PID %s",
-            lockfile_path,
-            contents or "unknown",
-        )
-        return
+    logging.info("Lock acquired, no other instances are running.")
+    print(f"{GREEN}Lock acquired, no other instances are running.{RESET}")
+    return lock
+
+
+def release_lock(lock: ProcessLock) -> None:
+    """Clear the recorded PID and drop the lock.
 
+    A flocked file is left in place: unlinking it would let a waiting
+    instance lock the old inode while a new one locks a fresh file.
+    """
     try:
-        lockfile_path.unlink()
-    except FileNotFoundError:
-        pass
+        if lock.remove_on_release:
+            lock.path.unlink()
+        else:
+            os.ftruncate(lock.descriptor, 0)
     except OSError as exc:
-        logging.error("Unable to remove lockfile %s: %s", lockfile_path, exc)
+        logging.error("Unable to clear lockfile %s: %s", lock.path, exc)
+
+    try:
+        os.close(lock.descriptor)
+    except OSError as exc:
+        logging.error("Unable to release lockfile %s: %s", lock.path, exc)
         print(
-            f"{RED}Unable to remove lockfile {lockfile_path}: {exc}{RESET}",
+            f"{RED}Unable to release lockfile {lock.path}: {exc}{RESET}",
             file=sys.stderr,
         )
         return
@@ -413,41 +826,47 @@ def release_lock(lockfile_path: Path) -> None:
     print(f"{GREEN}Lock released, script completed.{RESET}")
 
 
-def get_zfs_fs_list(settings: Settings) -> Dict[str, Dict[str, str]]:
+def get_zfs_fs_list(settings: Settings) -> Dict[str, str]:
+    """Map each filesystem and volume to its createtxg."""
     result = run_subprocess(
-        ["zfs", "list", "-Hp", "-o", "name"],
+        [
+            settings.zfs,
+            "list",
+            "-Hp",
+            "-t",
+            "filesystem,volume",
+            "-o",
+            "name,createtxg",
+        ],
         timeout=settings.command_timeout_seconds,
     )
     if result is None or result.returncode != 0:
         error = result.stderr.strip() if result else "zfs list did not run"
         raise RuntimeError(f"Unable to list ZFS filesystems: {error}")
 
-    return {fs: {} for fs in result.stdout.strip().splitlines() if fs}
+    filesystems: Dict[str, str] = {}
+    for line in result.stdout.splitlines():
+        fs, _, createtxg = line.partition("\t")
+        if fs:
+            filesystems[fs] = createtxg
+    return filesystems
 
 
-def send_to_zabbix(settings: Settings, host: str, key: str, value: str) -> bool:
-    sanitized_value = (
-        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', "")
-    )
-    command = [
-        "sudo",
+def zabbix_sender_command(settings: Settings) -> List[str]:
+    return [
         settings.zabbix_sender,
         "-z",
         settings.zabbix_server,
-        "-s",
-        host,
         "--tls-connect",
         "psk",
         "--tls-psk-identity",
         settings.psk_identity,
         "--tls-psk-file",
         settings.psk_file,
-        "-k",
-        key,
-        "-o",
-        sanitized_value,
     ]
-    process = run_subprocess(command, timeout=settings.command_timeout_seconds)
+
+
+def report_zabbix_result(process: Optional[subprocess.CompletedProcess]) -> bool:
     if process is None:
         return False
     if process.returncode != 0:
@@ -458,32 +877,155 @@ def send_to_zabbix(settings: Settings, host: str, key: str, value: str) -> bool:
     return True
 
 
-def set_backup_property(
+def quote_zabbix_field(value: str) -> str:
+    """Quote a field for zabbix_sender's input-file format."""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    # Escape backslashes first so the \n added here is not escaped again.
+    folded = escaped.replace("\r", "").replace("\n", "\\n")
+    return f'"{folded}"'
+
+
+def send_batch_to_zabbix(
     settings: Settings,
+    items: Sequence[Tuple[str, str, str]],
+) -> bool:
+    """Send (host, key, value) items over one zabbix_sender connection."""
+    if not items:
+        return True
+
+    lines = "".join(
+        " ".join(quote_zabbix_field(field) for field in item) + "\n"
+        for item in items
+    )
+    process = run_subprocess(
+        zabbix_sender_command(settings) + ["-i", "-"],
+        timeout=settings.command_timeout_seconds,
+        input_text=lines,
+        use_sudo=True,
+    )
+    return report_zabbix_result(process)
+
+
+def record_backup_status(
+    statuses: Dict[str, Tuple[str, str]],
     fs: str,
     status: str,
     message: str,
 ) -> None:
-    timestamp = datetime.datetime.now().isoformat()
-    status_message = f"{status} at {timestamp}: {message}"
+    statuses[fs] = (status, message)
+
+
+def set_lastbackup_properties(settings: Settings, statuses: Dict[str, str]) -> None:
+    """Write zab:lastbackup with one zfs set per distinct value."""
+    filesystems_by_value: Dict[str, List[str]] = collections.defaultdict(list)
+    for fs, status_message in statuses.items():
+        filesystems_by_value[status_message].append(fs)
+
+    for status_message, filesystems in filesystems_by_value.items():
+        for batch in iter_batches(filesystems, ZFS_SET_BATCH_SIZE):
+            result = run_subprocess(
+                [settings.zfs, "set", f"zab:lastbackup={status_message}", *batch],
+                timeout=settings.command_timeout_seconds,
+                capture_stdout=False,
+            )
+            if result is None or result.returncode != 0:
+                error = result.stderr.strip() if result else "zfs set did not run"
+                logging.error(
+                    "Unable to set zab:lastbackup on %s: %s",
+                    ", ".join(batch),
+                    error,
+                )
+
+
+def run_lastbackup_program(
+    settings: Settings,
+    script_path: str,
+    pool: str,
+    filesystems: Sequence[str],
+    statuses: Dict[str, str],
+) -> Optional[List[str]]:
+    """Set zab:lastbackup on one pool's filesystems in a single channel program.
+
+    Returns the filesystems the program could not update, or None if the
+    program itself did not run.
+    """
+    arguments = [item for fs in filesystems for item in (fs, statuses[fs])]
     result = run_subprocess(
-        ["zfs", "set", f"zab:lastbackup={status_message}", fs],
+        [settings.zfs, "program", "-j", "--", pool, script_path, *arguments],
         timeout=settings.command_timeout_seconds,
     )
-    if result is None or result.returncode != 0:
-        error = result.stderr.strip() if result else "zfs set did not run"
-        logging.error("Unable to set zab:lastbackup on %s: %s", fs, error)
-
+    if result is None:
+        return None
+    if result.returncode != 0:
+        logging.warning(
+            "zfs program failed on %s, falling back to zfs set: %s",
+            pool,
+            result.stderr.strip(),
+        )
+        return None
 
-def print_process_output(process: subprocess.CompletedProcess) -> None:
-    if process.stdout:
-        print(process.stdout, end="" if process.stdout.endswith("\n") else "\n")
-    if process.stderr:
-        print(
-            process.stderr,
-            end="" if process.stderr.endswith("\n") else "\n",
-            file=sys.stderr,
+    try:
+        failed = json.loads(result.stdout).get("return")
+    except (ValueError, AttributeError):
+        failed = None
+    if not isinstance(failed, dict):
+        logging.warning(
+            "Unexpected zfs program output on %s, falling back to zfs set: %s",
+            pool,
+            result.stdout.strip(),
         )
+        return None
+    return [fs for fs in filesystems if fs in failed]
+
+
+def apply_backup_statuses(settings: Settings, statuses: Dict[str, str]) -> None:
+    """Write zab:lastbackup with one channel program per pool where possible."""
+    if not statuses:
+        return
+
+    filesystems_by_pool: Dict[str, List[str]] = collections.defaultdict(list)
+    for fs in statuses:
+        filesystems_by_pool[fs.split("/", 1)[0]].append(fs)
+
+    pending: Dict[str, str] = {}
+    use_channel_programs = True
+    with tempfile.NamedTemporaryFile(
+        "w",
+        prefix="zabwrap-",
+        suffix=".lua",
+    ) as script:
+        script.write(LASTBACKUP_CHANNEL_PROGRAM)
+        script.flush()
+        for pool, filesystems in filesystems_by_pool.items():
+            for batch in iter_program_batches(filesystems, statuses):
+                failed = None
+                if use_channel_programs:
+                    failed = run_lastbackup_program(
+                        settings,
+                        script.name,
+                        pool,
+                        batch,
+                        statuses,
+                    )
+                if failed is None:
+                    use_channel_programs = False
+                    failed = list(batch)
+                pending.update((fs, statuses[fs]) for fs in failed)
+
+    set_lastbackup_properties(settings, pending)
+
+
+def report_backup_statuses(settings: Settings, statuses: Dict[str, str]) -> None:
+    """Send each filesystem's status to Zabbix in a single batch, if enabled."""
+    if not settings.zabbix_host or not statuses:
+        return
+
+    items = [
+        (settings.zabbix_host, f"{settings.zabbix_key}[{fs}]", status_message)
+        for fs, status_message in sorted(statuses.items())
+    ]
+    if not send_batch_to_zabbix(settings, items):
+        logging.error("Unable to report %d backup statuses to Zabbix", len(items))
 
 
 def execute_zfs_autobackup(
@@ -492,38 +1034,45 @@ def execute_zfs_autobackup(
     dry_run: bool,
     fs: str,
     success_message: str,
+    statuses: Dict[str, Tuple[str, str]],
+    prefix_output: bool = True,
 ) -> bool:
     """Run zfs-autobackup, adding --test for a read-only dry run."""
     command = list(command_parts)
     if dry_run:
         command.append("--test")
 
+    command_text = " ".join(command)
     mode = "TEST" if dry_run else "RUN"
-    print(f"{GREEN}[{mode}] Command:{RESET} {' '.join(command)}")
-    logging.info("[%s] Running command: %s", mode, " ".join(command))
+    with OUTPUT_LOCK:
+        print(f"{GREEN}[{mode}] Command:{RESET} {command_text}")
+    logging.info("[%s] Running command: %s", mode, command_text)
 
-    result = run_subprocess(command, timeout=settings.command_timeout_seconds)
+    result = run_streaming_subprocess(
+        command,
+        f"[{fs}] " if prefix_output else None,
+        timeout=settings.command_timeout_seconds,
+    )
     if result is None:
         if not dry_run:
-            set_backup_property(
-                settings,
+            record_backup_status(
+                statuses,
                 fs,
                 "failed",
-                f"Backup timed out: {' '.join(command)}",
+                f"Backup timed out: {command_text}",
             )
         return False
 
-    print_process_output(result)
-
     if result.returncode == 0:
         if dry_run:
             logging.info("Test completed successfully for %s", fs)
-            print(
-                f"{GREEN}Test completed successfully for {fs}; "
-                f"no changes were made.{RESET}"
-            )
+            with OUTPUT_LOCK:
+                print(
+                    f"{GREEN}Test completed successfully for {fs}; "
+                    f"no changes were made.{RESET}"
+                )
         else:
-            set_backup_property(settings, fs, "success", success_message)
+            record_backup_status(statuses, fs, "success", success_message)
         return True
 
     failure = (
@@ -532,10 +1081,19 @@ def execute_zfs_autobackup(
     )
     logging.error("Backup failed for %s: %s", fs, failure)
     if not dry_run:
-        set_backup_property(settings, fs, "failed", failure)
+        record_backup_status(statuses, fs, "failed", failure)
     return False
 
 
+def option_arguments(options: Dict[str, Optional[str]]) -> List[str]:
+    arguments: List[str] = []
+    for flag, value in options.items():
+        arguments.append(flag)
+        if value is not None:
+            arguments.append(value)
+    return arguments
+
+
 def run_backup(
     settings: Settings,
     dry_run: bool,
@@ -544,34 +1102,33 @@ def run_backup(
     server: str,
     retention: str,
     path: str,
+    statuses: Dict[str, Tuple[str, str]],
+    ssh_config: Optional[Path] = None,
+    prefix_output: bool = True,
 ) -> bool:
+    options: Dict[str, Optional[str]] = {
+        "--keep-source": retention,
+        "--ssh-target": server,
+        "--keep-target": retention,
+        **REMOTE_BACKUP_OPTIONS,
+    }
+    if ssh_config is not None:
+        options["--ssh-config"] = str(ssh_config)
     command_parts = [
         settings.zfs_autobackup,
         zabselect,
         path,
-        "--verbose",
-        "--keep-source",
-        retention,
-        "--ssh-target",
-        server,
-        "--keep-target",
-        retention,
-        "--strip-path",
-        "1",
-        "--clear-mountpoint",
-        "--exclude-received",
-        # Always enabled by design. This preserves and transfers snapshots
-        # not created by zfs-autobackup.
-        "--other-snapshots",
+        *option_arguments(options),
     ]
 
-    # --destroy-incompatible is intentionally not used during routine backups.
     return execute_zfs_autobackup(
         settings,
         command_parts,
         dry_run,
         fs,
         "Backup successful",
+        statuses,
+        prefix_output,
     )
 
 
@@ -581,147 +1138,406 @@ def run_sandbox_backup(
     fs: str,
     zabselect: str,
     retention: str,
+    statuses: Dict[str, Tuple[str, str]],
+    prefix_output: bool = True,
 ) -> bool:
     """Create and thin local snapshots without a target dataset."""
     command_parts = [
         settings.zfs_autobackup,
         zabselect,
-        "--verbose",
-        "--keep-source",
-        retention,
-        "--exclude-received",
-        # Kept enabled consistently with normal backups.
-        "--other-snapshots",
+        *option_arguments({"--keep-source": retention, **SANDBOX_BACKUP_OPTIONS}),
     ]
 
-    # No target-only options are included here. With no target path,
-    # zfs-autobackup creates a local snapshot and thins source snapshots.
     return execute_zfs_autobackup(
         settings,
         command_parts,
         dry_run,
         fs,
         "Sandbox snapshot and thinning successful",
+        statuses,
+        prefix_output,
     )
 
 
-def read_zfs_property(
+def iter_batches(
+    items: Sequence[str],
+    size: int = ZFS_GET_BATCH_SIZE,
+) -> Iterator[Sequence[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def iter_program_batches(
+    filesystems: Sequence[str],
+    statuses: Dict[str, str],
+) -> Iterator[List[str]]:
+    """Group filesystems for zfs program by count and by argument bytes."""
+    batch: List[str] = []
+    batch_bytes = 0
+    for fs in filesystems:
+        # Both arguments also cost a terminating NUL and an argv pointer.
+        fs_bytes = len(fs.encode()) + len(statuses[fs].encode()) + 2 * (1 + 8)
+        if batch and (
+            len(batch) >= ZFS_SET_BATCH_SIZE
+            or batch_bytes + fs_bytes > ZFS_PROGRAM_ARGUMENT_BYTES
+        ):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(fs)
+        batch_bytes += fs_bytes
+    if batch:
+        yield batch
+
+
+def read_zfs_properties(
     settings: Settings,
-    fs: str,
-    property_name: str,
-    local_only: bool = False,
-) -> Optional[str]:
-    command = ["zfs", "get"]
-    if local_only:
-        command.extend(["-s", "local"])
-    command.extend(["-H", "-o", "value", property_name, fs])
+    filesystems: Sequence[str],
+    property_names: Sequence[str],
+    sources: Optional[str] = None,
+) -> Dict[str, Dict[str, Tuple[str, str]]]:
+    """Read (value, source) pairs from several datasets with one zfs get call.
+
+    Datasets zfs cannot open, such as ones destroyed since they were listed,
+    are reported and left out of the result.
+    """
+    command = [settings.zfs, "get", "-H", "-p"]
+    if sources:
+        command.extend(["-s", sources])
+    command.extend(
+        [
+            "-o",
+            "name,property,value,source",
+            ",".join(dict.fromkeys(property_names)),
+        ]
+    )
+    command.extend(filesystems)
 
     result = run_subprocess(command, timeout=settings.command_timeout_seconds)
-    if result is None or result.returncode != 0:
-        error = result.stderr.strip() if result else "zfs get did not run"
-        logging.error(
-            "Unable to read %s from %s: %s",
-            property_name,
-            fs,
-            error,
-        )
-        print(
-            f"{RED}Unable to read {property_name} from {fs}: {error}{RESET}",
-            file=sys.stderr,
-        )
-        return None
+    if result is None:
+        raise RuntimeError("Unable to read ZFS properties: zfs get did not run")
+
+    properties: Dict[str, Dict[str, Tuple[str, str]]] = {
+        fs: {} for fs in filesystems
+    }
+    if result.returncode != 0:
+        unreadable = {
+            match.group(1): match.group(0)
+            for match in ZFS_CANNOT_OPEN_PATTERN.finditer(result.stderr)
+            if match.group(1) in properties
+        }
+        if not unreadable:
+            raise RuntimeError(
+                f"Unable to read ZFS properties: {result.stderr.strip()}"
+            )
+        for fs, error in unreadable.items():
+            logging.error("Unable to read ZFS properties for %s: %s", fs, error)
+            with OUTPUT_LOCK:
+                print(
+                    f"{RED}Unable to read ZFS properties for {fs}: {error}{RESET}",
+                    file=sys.stderr,
+                )
+            del properties[fs]
 
-    return result.stdout.strip()
+    for line in result.stdout.splitlines():
+        fields = line.split("\t", 2)
+        if len(fields) != 3:
+            continue
+        name, property_name, remainder = fields
+        value, _, source = remainder.rpartition("\t")
+        properties.setdefault(name, {})[property_name] = (value, source)
 
+    return properties
 
-def decode_backup_path(encoded_path: str) -> str:
-    placeholder = "<<HYPHEN>>"
+
+def iter_zfs_properties(
+    settings: Settings,
+    filesystems: Sequence[str],
+    property_names: Sequence[str],
+    sources: Optional[str],
+    concurrency: int,
+) -> Iterator[Dict[str, Dict[str, Tuple[str, str]]]]:
+    """Run the batched zfs get calls side by side, yielding each as it finishes."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                read_zfs_properties,
+                settings,
+                batch,
+                property_names,
+                sources,
+            )
+            for batch in iter_batches(filesystems)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def iter_filesystem_properties(
+    settings: Settings,
+    filesystems: Sequence[str],
+    zabselects: Dict[str, str],
+    createtxgs: Dict[str, str],
+    concurrency: int,
+    failures: List[str],
+) -> Iterator[Tuple[str, Dict[str, str], Optional[Dict[str, str]]]]:
+    """Yield each filesystem's selection and zab:* properties as they arrive.
+
+    Fresh cache entries come first, then each zfs get batch as it completes;
+    the zab:* properties are None for filesystems that are not selected.
+    Filesystems whose properties could not be read are added to failures.
+    """
+    cache_enabled = settings.cache_ttl_seconds > 0
+    pool_stamp = zpool_cache_stamp() if cache_enabled else None
+    cache = (
+        load_property_cache(settings.cache_file, pool_stamp)
+        if cache_enabled
+        else {}
+    )
+    now = time.time()
+
+    stale: List[str] = []
+    for fs in filesystems:
+        entry: Any = cache.get(fs)
+        if cache_entry_is_fresh(entry, createtxgs[fs], now, settings.cache_ttl_seconds):
+            yield fs, entry["selection"], entry["properties"]
+        else:
+            stale.append(fs)
+
+    fetched_entries: Dict[str, Dict[str, object]] = {}
+    for fetched in iter_zfs_properties(
+        settings,
+        stale,
+        ["all"],
+        USER_PROPERTY_SOURCES,
+        concurrency,
+    ):
+        for fs, properties in fetched.items():
+            # Selection follows the filesystem's own local property only; an
+            # inherited autobackup:* belongs to the parent's run.
+            selection = {
+                name: value
+                for name, (value, source) in properties.items()
+                if name.startswith("autobackup:") and source == "local"
+            }
+            backup_properties: Optional[Dict[str, str]] = None
+            if selection.get("autobackup:" + zabselects[fs], "").lower() == "true":
+                backup_properties = {
+                    name: properties[name][0]
+                    for name in ("zab:backuptype", "zab:server")
+                    if name in properties
+                }
+            fetched_entries[fs] = {
+                "createtxg": createtxgs[fs],
+                "fetched_at": now,
+                "selection": selection,
+                "properties": backup_properties,
+            }
+            yield fs, selection, backup_properties
+
+    failures.extend(fs for fs in stale if fs not in fetched_entries)
+    if cache_enabled and fetched_entries:
+        entries = {fs: entry for fs, entry in cache.items() if fs in createtxgs}
+        entries.update(fetched_entries)
+        save_property_cache(settings.cache_file, entries, pool_stamp)
+
+
+def cache_entry_is_fresh(
+    entry: Any,
+    createtxg: str,
+    now: float,
+    ttl_seconds: int,
+) -> bool:
+    if not isinstance(entry, dict):
+        return False
+    fetched_at = entry.get("fetched_at")
+    properties = entry.get("properties")
     return (
-        encoded_path.replace("--", placeholder)
-        .replace("-", "/")
-        .replace(placeholder, "-")
+        entry.get("createtxg") == createtxg
+        and isinstance(fetched_at, (int, float))
+        and 0 <= now - fetched_at < ttl_seconds
+        and isinstance(entry.get("selection"), dict)
+        and (properties is None or isinstance(properties, dict))
     )
 
 
-def zabwrap(
+def zpool_cache_stamp() -> Optional[int]:
+    """Return the zpool.cache modification time, or None if it is missing."""
+    try:
+        return ZPOOL_CACHE_FILE.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_property_cache(
+    cache_file: Path,
+    pool_stamp: Optional[int],
+) -> Dict[str, Any]:
+    try:
+        with cache_file.open(encoding="utf-8") as stream:
+            data = json.load(stream)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        logging.warning("Ignoring unreadable property cache %s: %s", cache_file, exc)
+        return {}
+
+    if not isinstance(data, dict) or data.get("version") != PROPERTY_CACHE_VERSION:
+        return {}
+    if data.get("pool_stamp") != pool_stamp:
+        return {}
+    filesystems = data.get("filesystems")
+    return filesystems if isinstance(filesystems, dict) else {}
+
+
+def save_property_cache(
+    cache_file: Path,
+    entries: Dict[str, Any],
+    pool_stamp: Optional[int],
+) -> None:
+    """Replace the cache file atomically so readers never see a partial one."""
+    temporary = cache_file.with_name(cache_file.name + ".tmp")
+    try:
+        cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        descriptor = os.open(
+            str(temporary),
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            0o600,
+        )
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            json.dump(
+                {
+                    "version": PROPERTY_CACHE_VERSION,
+                    "pool_stamp": pool_stamp,
+                    "filesystems": entries,
+                },
+                stream,
+            )
+        os.replace(temporary, cache_file)
+    except OSError as exc:
+        logging.error("Unable to write property cache %s: %s", cache_file, exc)
+
+
+def selection_name(fs: str) -> str:
+    """Return the zfs-autobackup selection name used for a filesystem."""
+    return fs.translate(SELECTION_NAME_TABLE)
+
+
+def decode_backup_path(encoded_path: str) -> str:
+    """Decode a zab:server path, where "-" is "/" and "--" is a literal "-"."""
+    return "-".join(part.replace("-", "/") for part in encoded_path.split("--"))
+
+
+def report_orphans(
+    filesystem_properties: Iterable[
+        Tuple[str, Dict[str, str], Optional[Dict[str, str]]]
+    ],
+) -> Iterator[Tuple[str, Dict[str, str], Optional[Dict[str, str]]]]:
+    """Pass filesystem properties through, then print the unselected ones."""
+    orphaned: List[str] = []
+    for fs, selection, properties in filesystem_properties:
+        # A local autobackup:<other>=true puts the filesystem in another
+        # filesystem's zfs-autobackup run, so it is not an orphan.
+        if properties is None and not any(
+            value.lower() == "true" for value in selection.values()
+        ):
+            orphaned.append(fs)
+        yield fs, selection, properties
+
+    if orphaned:
+        with OUTPUT_LOCK:
+            print("\n".join(orphaned))
+
+
+def plan_backups(
     settings: Settings,
-    dry_run: bool,
     orphans: bool,
     limit: Optional[Sequence[str]],
     debug: bool,
-) -> bool:
-    filesystems = list(limit) if limit else list(get_zfs_fs_list(settings))
-    all_succeeded = True
+    concurrency: int,
+    failures: List[str],
+) -> Iterator[BackupTask]:
+    """Yield the backup work for each selected filesystem as it is resolved.
+
+    Filesystems that cannot be planned are added to failures.
+    """
+    if limit:
+        requested = []
+        for fs in dict.fromkeys(limit):
+            if not DATASET_NAME_PATTERN.fullmatch(fs):
+                logging.error("Invalid filesystem name: %s", fs)
+                print(
+                    f"{RED}Invalid filesystem name: {fs}{RESET}",
+                    file=sys.stderr,
+                )
+                failures.append(fs)
+                continue
+            requested.append(fs)
 
-    for fs in filesystems:
-        zabprop = "autobackup:" + fs.replace("/", "-").lower()
-        zabselect = fs.replace("/", "-").lower()
+        known_filesystems = get_zfs_fs_list(settings) if requested else {}
+        filesystems = []
+        for fs in requested:
+            if fs not in known_filesystems:
+                logging.error("Filesystem does not exist: %s", fs)
+                print(
+                    f"{RED}Filesystem does not exist: {fs}{RESET}",
+                    file=sys.stderr,
+                )
+                failures.append(fs)
+                continue
+            filesystems.append(fs)
+    else:
+        known_filesystems = get_zfs_fs_list(settings)
+        filesystems = list(known_filesystems)
 
-        backupsfs = read_zfs_property(
-            settings,
-            fs,
-            zabprop,
-            local_only=True,
-        )
-        if backupsfs is None:
-            all_succeeded = False
-            continue
+    zabselects = {fs: selection_name(fs) for fs in filesystems}
+    filesystem_properties = iter_filesystem_properties(
+        settings,
+        filesystems,
+        zabselects,
+        known_filesystems,
+        concurrency,
+        failures,
+    )
+    if orphans:
+        filesystem_properties = report_orphans(filesystem_properties)
 
-        if backupsfs.lower() != "true":
-            if orphans:
-                print(fs)
+    for fs, _, properties in filesystem_properties:
+        if properties is None:
             continue
 
+        zabselect = zabselects[fs]
+        zabprop = "autobackup:" + zabselect
         if debug:
-            print(f"Filesystem selected by {zabprop}=true: {fs}")
+            with OUTPUT_LOCK:
+                print(f"Filesystem selected by {zabprop}=true: {fs}")
 
-        backupfstype = read_zfs_property(
-            settings,
-            fs,
-            "zab:backuptype",
-        )
-        if backupfstype is None:
-            all_succeeded = False
-            continue
-
-        backupfstype = backupfstype.lower()
-        if backupfstype not in settings.backup_types:
+        backupfstype = properties.get("zab:backuptype", "-").strip().lower()
+        retention = settings.backup_types.get(backupfstype)
+        if retention is None:
             logging.error(
                 "Unknown backup type for filesystem %s: %s",
                 fs,
                 backupfstype,
             )
-            print(
-                f"{RED}Unknown backup type for filesystem {fs}: "
-                f"{backupfstype}{RESET}",
-                file=sys.stderr,
-            )
-            all_succeeded = False
+            with OUTPUT_LOCK:
+                print(
+                    f"{RED}Unknown backup type for filesystem {fs}: "
+                    f"{backupfstype}{RESET}",
+                    file=sys.stderr,
+                )
+            failures.append(fs)
             continue
 
         if backupfstype == "scratch":
-            print(f"{YELLOW}Filesystem backup type is scratch: {RESET}{fs}")
+            with OUTPUT_LOCK:
+                print(f"{YELLOW}Filesystem backup type is scratch: {RESET}{fs}")
             continue
 
-        retention = settings.backup_types[backupfstype]
-
         if backupfstype == "sandbox":
-            print(f"{YELLOW}Running local-only sandbox snapshots for {fs}{RESET}")
-            if not run_sandbox_backup(
-                settings,
-                dry_run,
-                fs,
-                zabselect,
-                retention,
-            ):
-                all_succeeded = False
-            continue
-
-        backupdest = read_zfs_property(settings, fs, "zab:server")
-        if backupdest is None:
-            all_succeeded = False
+            yield BackupTask(fs, zabselect, retention, sandbox=True)
             continue
 
+        backupdest = properties.get("zab:server", "-")
         backup_servers = [
             destination.strip()
             for destination in backupdest.split(",")
@@ -729,13 +1545,15 @@ def zabwrap(
         ]
         if not backup_servers:
             logging.error("No backup destinations configured for %s", fs)
-            print(
-                f"{RED}No backup destinations configured for {fs}.{RESET}",
-                file=sys.stderr,
-            )
-            all_succeeded = False
+            with OUTPUT_LOCK:
+                print(
+                    f"{RED}No backup destinations configured for {fs}.{RESET}",
+                    file=sys.stderr,
+                )
+            failures.append(fs)
             continue
 
+        destinations: List[Tuple[str, str]] = []
         for destination in backup_servers:
             try:
                 server, encoded_path = destination.split(":", 1)
@@ -744,12 +1562,13 @@ def zabwrap(
                     "The zfs attribute zab:server contains an error: %s",
                     destination,
                 )
-                print(
-                    f"{RED}The zfs attribute zab:server contains an error: "
-                    f"{destination}{RESET}",
-                    file=sys.stderr,
-                )
-                all_succeeded = False
+                with OUTPUT_LOCK:
+                    print(
+                        f"{RED}The zfs attribute zab:server contains an error: "
+                        f"{destination}{RESET}",
+                        file=sys.stderr,
+                    )
+                failures.append(fs)
                 continue
 
             server = server.strip()
@@ -760,29 +1579,198 @@ def zabwrap(
                     "destination: %s",
                     destination,
                 )
-                print(
-                    f"{RED}The zfs attribute zab:server contains an incomplete "
-                    f"destination: {destination}{RESET}",
-                    file=sys.stderr,
-                )
-                all_succeeded = False
+                with OUTPUT_LOCK:
+                    print(
+                        f"{RED}The zfs attribute zab:server contains an incomplete "
+                        f"destination: {destination}{RESET}",
+                        file=sys.stderr,
+                    )
+                failures.append(fs)
                 continue
 
-            path = decode_backup_path(encoded_path)
-            if not run_backup(
-                settings,
-                dry_run,
-                fs,
-                zabselect,
-                server,
-                retention,
-                path,
-            ):
-                all_succeeded = False
+            destinations.append((server, decode_backup_path(encoded_path)))
+
+        if destinations:
+            yield BackupTask(fs, zabselect, retention, destinations)
+
+
+def start_ssh_multiplexing(settings: Settings) -> Path:
+    """Write an ssh config that shares one master connection per target."""
+    control_dir = Path(tempfile.mkdtemp(prefix="zabwrap-ssh-"))
+    ssh_config = control_dir / "ssh_config"
+    # -F skips the user and system configuration, so include them again
+    # after the multiplexing options, which take precedence.
+    ssh_config.write_text(
+        "ControlMaster auto\n"
+        f"ControlPath {control_dir}/%C\n"
+        f"ControlPersist {settings.ssh_control_persist_seconds}\n"
+        "Include ~/.ssh/config\n"
+        "Include /etc/ssh/ssh_config\n",
+        encoding="utf-8",
+    )
+    return ssh_config
+
+
+def stop_ssh_multiplexing(
+    settings: Settings,
+    ssh_config: Path,
+    servers: Sequence[str],
+) -> None:
+    for server in servers:
+        run_subprocess(
+            [settings.ssh, "-F", str(ssh_config), "-O", "exit", server],
+            timeout=settings.command_timeout_seconds,
+        )
+    shutil.rmtree(ssh_config.parent, ignore_errors=True)
+
+
+def run_backup_task(
+    settings: Settings,
+    dry_run: bool,
+    task: BackupTask,
+    statuses: Dict[str, Tuple[str, str]],
+    ssh_config: Optional[Path] = None,
+    prefix_output: bool = True,
+) -> bool:
+    """Run every backup for one filesystem; its destinations run in order."""
+    if task.sandbox:
+        with OUTPUT_LOCK:
+            print(
+                f"{YELLOW}Running local-only sandbox snapshots for "
+                f"{task.fs}{RESET}"
+            )
+        return run_sandbox_backup(
+            settings,
+            dry_run,
+            task.fs,
+            task.zabselect,
+            task.retention,
+            statuses,
+            prefix_output,
+        )
 
+    all_succeeded = True
+    for server, path in task.destinations:
+        if not run_backup(
+            settings,
+            dry_run,
+            task.fs,
+            task.zabselect,
+            server,
+            task.retention,
+            path,
+            statuses,
+            ssh_config,
+            prefix_output,
+        ):
+            all_succeeded = False
     return all_succeeded
 
 
+def dispatch_backups(
+    settings: Settings,
+    dry_run: bool,
+    tasks: Iterable[BackupTask],
+    concurrency: int,
+) -> bool:
+    """Run backup tasks on a bounded pool, submitting each as it is planned."""
+    # One timestamp for the whole run lets identical results share a zfs set.
+    run_started = datetime.datetime.now().isoformat(timespec="seconds")
+    statuses: Dict[str, Tuple[str, str]] = {}
+    servers: Set[str] = set()
+    ssh_config = start_ssh_multiplexing(settings) if settings.ssh_multiplex else None
+    progress_lock = threading.Lock()
+    progress = {"submitted": 0, "finished": 0}
+
+    def log_completion(task: BackupTask, future: concurrent.futures.Future) -> None:
+        if future.cancelled():
+            return
+        succeeded = future.exception() is None and future.result()
+        with progress_lock:
+            progress["finished"] += 1
+            finished, submitted = progress["finished"], progress["submitted"]
+        logging.info(
+            "Finished %s (%d/%d submitted): %s",
+            task.fs,
+            finished,
+            submitted,
+            "succeeded" if succeeded else "failed",
+        )
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency
+        ) as executor:
+            futures: List[concurrent.futures.Future] = []
+            try:
+                for task in tasks:
+                    servers.update(server for server, _ in task.destinations)
+                    with progress_lock:
+                        progress["submitted"] += 1
+                    future = executor.submit(
+                        run_backup_task,
+                        settings,
+                        dry_run,
+                        task,
+                        statuses,
+                        ssh_config,
+                        # Only interleaved output needs a per-filesystem prefix.
+                        concurrency > 1,
+                    )
+                    # Completions are logged as they happen, even while later
+                    # tasks are still being planned.
+                    future.add_done_callback(functools.partial(log_completion, task))
+                    futures.append(future)
+                all_succeeded = all([future.result() for future in futures])
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                # Ctrl-C lands here, not in the workers waiting on zfs-autobackup.
+                kill_running_processes()
+                raise
+            except BaseException:
+                # Only backups already running are waited for and recorded.
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        if ssh_config is not None:
+            stop_ssh_multiplexing(settings, ssh_config, sorted(servers))
+        # Backups may already have run when planning fails part way.
+        status_messages = {
+            fs: f"{status} at {run_started}: {message}"
+            for fs, (status, message) in statuses.items()
+        }
+        apply_backup_statuses(settings, status_messages)
+        report_backup_statuses(settings, status_messages)
+
+    return all_succeeded
+
+
+def zabwrap(
+    settings: Settings,
+    dry_run: bool,
+    orphans: bool,
+    limit: Optional[Sequence[str]],
+    debug: bool,
+    concurrency: int,
+) -> bool:
+    planning_failures: List[str] = []
+    tasks: Iterable[BackupTask] = plan_backups(
+        settings,
+        orphans,
+        limit,
+        debug,
+        concurrency,
+        planning_failures,
+    )
+    if concurrency == 1:
+        # Serial backups write straight to the terminal, so finish planning
+        # and its messages first to keep the output in order.
+        tasks = list(tasks)
+    # Otherwise backups start while later property batches are still read.
+    succeeded = dispatch_backups(settings, dry_run, tasks, concurrency)
+    return succeeded and not planning_failures
+
+
 def main() -> int:
     parser = build_argument_parser()
     args = parser.parse_args()
@@ -806,16 +1794,16 @@ def main() -> int:
     if args.debug:
         print_effective_config(settings)
 
-    lock_acquired = False
+    lock: Optional[ProcessLock] = None
     try:
-        acquire_lock(settings.lockfile_path)
-        lock_acquired = True
+        lock = acquire_lock(settings.lockfile_path)
         succeeded = zabwrap(
             settings,
             args.dry_run,
             args.orphans,
             args.limit,
             args.debug,
+            args.concurrency or settings.concurrency,
         )
         return 0 if succeeded else 1
     except RuntimeError as exc:
@@ -823,8 +1811,8 @@ def main() -> int:
         print(f"{RED}{exc}{RESET}", file=sys.stderr)
         return 1
     finally:
-        if lock_acquired:
-            release_lock(settings.lockfile_path)
+        if lock is not None:
+            release_lock(lock)
 
 
 if __name__ == "__main__":